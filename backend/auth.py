@@ -1,5 +1,8 @@
+import asyncio
 import os
+import time
 import jwt
+from cachetools import TLRUCache
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from supabase import create_client, Client
@@ -8,20 +11,40 @@ from loguru import logger
 # Initialize Supabase client
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+# JWT secret used by Supabase to sign access tokens (Settings -> API -> JWT Secret)
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 
 if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
     logger.warning("Supabase credentials not found in environment variables")
     supabase: Client = None
+    supabase_admin: Client = None
 else:
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    # Separate service-role client for database RPCs. It never signs users in, so
+    # its Authorization header can't be swapped to a user's JWT by auth events.
+    supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
 # Security scheme for bearer token
 security = HTTPBearer()
 
+# Cache of verified tokens: raw JWT -> (user data, exp).
+# Entries never outlive the token's own `exp` claim, and are capped at 5 minutes
+# so revoked sessions are picked up reasonably quickly.
+JWT_CACHE_MAX_TTL = 300
+_JWT_CACHE = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _token, entry, now: min(entry[1], now + JWT_CACHE_MAX_TTL),
+    timer=time.time,
+)
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> dict:
     """
     Verify JWT token from Supabase and return user data.
     
+    The signature is checked locally with SUPABASE_JWT_SECRET. Supabase is only
+    asked to validate the token when no secret is configured or the local check
+    fails on the key (e.g. after a secret rotation).
+    
     Args:
         credentials: HTTP Authorization credentials with bearer token
         
@@ -34,21 +57,57 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Security(secu
     try:
         token = credentials.credentials
         
-        # Verify token with Supabase
-        user_response = supabase.auth.get_user(token)
+        cached = _JWT_CACHE.get(token)
+        if cached is not None:
+            return cached[0]
+        
+        user = None
+        if SUPABASE_JWT_SECRET:
+            try:
+                payload = jwt.decode(
+                    token,
+                    SUPABASE_JWT_SECRET,
+                    algorithms=["HS256"],
+                    audience="authenticated",
+                    options={"require": ["exp", "sub"]}
+                )
+                exp = payload["exp"]
+                user = {
+                    "id": payload["sub"],
+                    "email": payload.get("email"),
+                    "user_metadata": payload.get("user_metadata", {})
+                }
+            except (jwt.InvalidSignatureError, jwt.InvalidAlgorithmError) as e:
+                logger.warning(f"Local token verification failed, falling back to Supabase: {e}")
+        
+        if user is None:
+            # Read `exp` without verifying, only to bound the cache entry lifetime
+            exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+            if not exp or exp <= time.time():
+                raise HTTPException(
+                    status_code=401,
+                    detail="Token expired"
+                )
+            
+            # Verify token with Supabase (sync client, so keep it off the event loop)
+            user_response = await asyncio.to_thread(supabase.auth.get_user, token)
+            
+            if not user_response or not user_response.user:
+                raise HTTPException(
+                    status_code=401,
+                    detail="Invalid authentication token"
+                )
+            
+            user = {
+                "id": user_response.user.id,
+                "email": user_response.user.email,
+                "user_metadata": user_response.user.user_metadata
+            }
         
-        if not user_response or not user_response.user:
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid authentication token"
-            )
+        _JWT_CACHE[token] = (user, exp)
         
         # Return user data
-        return {
-            "id": user_response.user.id,
-            "email": user_response.user.email,
-            "user_metadata": user_response.user.user_metadata
-        }
+        return user
         
     except Exception as e:
         logger.error(f"Token verification failed: {e}")
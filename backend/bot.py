@@ -24,49 +24,10 @@ from pipecat.frames.frames import TranscriptionFrame, TextFrame, OutputTransport
 load_dotenv()
 
 logger.remove()
-logger.add(sys.stderr, level="DEBUG")
+logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", "INFO"))
 
-class TextSender(FrameProcessor):
-    def __init__(self):
-        super().__init__()
-
-    async def process_frame(self, frame, direction):
-        await super().process_frame(frame, direction)
-
-        if isinstance(frame, TranscriptionFrame):
-            print(f"DEBUG: TextSender received TranscriptionFrame: {frame.text}")
-            # Safely access is_final, default to True (Deepgram usually sends final frames here?)
-            # Actually, let's check if it has the attribute.
-            is_final = getattr(frame, "is_final", True)
-            msg = {"type": "transcription", "text": frame.text, "is_final": is_final, "role": "user"}
-            await self.push_frame(OutputTransportMessageFrame(message=msg), direction)
-        
-        elif isinstance(frame, TextFrame):
-            print(f"DEBUG: TextSender received TextFrame: {frame.text}")
-            msg = {"type": "text", "text": frame.text, "role": "assistant"}
-            await self.push_frame(OutputTransportMessageFrame(message=msg), direction)
-        
-        elif isinstance(frame, OutputTransportMessageFrame):
-             print(f"DEBUG: TextSender passing through OutputTransportMessageFrame: {frame.message}")
-
-        await self.push_frame(frame, direction)
-
-async def run_bot(transport, args: RunnerArguments, user_name: str = None):
-    """Main bot logic"""
-    
-    # Create AI Services
-    stt = DeepgramSTTService(api_key=os.getenv("DEEPGRAM_API_KEY"))
-    tts = CartesiaTTSService(
-        api_key=os.getenv("CARTESIA_API_KEY"),
-        voice_id="bdab08ad-4137-4548-b9db-6142854c7525",  # Default Cartesia voice
-    )
-    llm = OpenAILLMService(api_key=os.getenv("OPENAI_API_KEY"), model="gpt-4o-mini")
-    
-    # Conversation context with custom persona
-    messages = [
-        {
-    "role": "system",
-    "content": """You are an AI voice assistant representing Sanket, a passionate Full Stack Developer and GenAI/ML Engineer. You are here to answer questions about your professional life, skills, and aspirations in a natural, conversational manner.
+# System prompt with the custom persona, built once and shared by every session
+SYSTEM_PROMPT: str = """You are an AI voice assistant representing Sanket, a passionate Full Stack Developer and GenAI/ML Engineer. You are here to answer questions about your professional life, skills, and aspirations in a natural, conversational manner.
 
 **About You**:
 You're currently pursuing a dual degree - B.Tech in Computer Science and Engineering (AI) from VIIT Pune (CGPA: 7.99) and B.S in Data Science and Applications from IIT Madras (CGPA: 8.64). You're a GenAI Software Intern at alphashot.ai (SF, USA) since May 2025, where you engineer multi-agent orchestration platforms using Google ADK, FastAPI, and Supabase.
@@ -125,9 +86,84 @@ You believe in learning by building production-ready systems. You prefer Docker
 - Use specific technical details when relevant but explain them naturally
 - Speak with confidence about your experience while staying humble about continuous learning
 - If asked something not covered, answer authentically based on the persona of a senior GenAI engineer who loves building production systems"""
-},
 
-    ]
+BASE_MESSAGES: tuple[dict, ...] = (
+    {"role": "system", "content": SYSTEM_PROMPT},
+)
+
+class TextSender(FrameProcessor):
+    # Frame class -> whether its frames carry `is_final`, resolved once per class
+    _HAS_IS_FINAL: dict[type, bool] = {}
+
+    def __init__(self):
+        super().__init__()
+
+    async def _handle_transcription(self, frame, direction):
+        logger.trace("TextSender received TranscriptionFrame: {}", frame.text)
+        # is_final defaults to True (Deepgram sends final transcriptions as TranscriptionFrame).
+        # Checked on the instance since dataclass fields without defaults aren't class attributes.
+        cls = type(frame)
+        has_is_final = self._HAS_IS_FINAL.get(cls)
+        if has_is_final is None:
+            has_is_final = hasattr(frame, "is_final")
+            self._HAS_IS_FINAL[cls] = has_is_final
+        is_final = frame.is_final if has_is_final else True
+        msg = {"type": "transcription", "text": frame.text, "is_final": is_final, "role": "user"}
+        await self.push_frame(OutputTransportMessageFrame(message=msg), direction)
+
+    async def _handle_text(self, frame, direction):
+        logger.trace("TextSender received TextFrame: {}", frame.text)
+        msg = {"type": "text", "text": frame.text, "role": "assistant"}
+        await self.push_frame(OutputTransportMessageFrame(message=msg), direction)
+
+    async def _handle_passthrough(self, frame, direction):
+        logger.trace("TextSender passing through OutputTransportMessageFrame: {}", frame.message)
+
+    _HANDLERS = {
+        TranscriptionFrame: _handle_transcription,
+        TextFrame: _handle_text,
+        OutputTransportMessageFrame: _handle_passthrough,
+    }
+
+    # Frame class -> handler (or None). Resolved through the MRO once per class so
+    # subclasses like LLMTextFrame still reach the TextFrame handler.
+    _HANDLER_CACHE: dict = {}
+
+    @classmethod
+    def _resolve_handler(cls, frame_cls):
+        for base in frame_cls.__mro__:
+            handler = cls._HANDLERS.get(base)
+            if handler is not None:
+                return handler
+        return None
+
+    async def process_frame(self, frame, direction):
+        await super().process_frame(frame, direction)
+
+        frame_cls = type(frame)
+        if frame_cls in self._HANDLER_CACHE:
+            handler = self._HANDLER_CACHE[frame_cls]
+        else:
+            handler = self._HANDLER_CACHE[frame_cls] = self._resolve_handler(frame_cls)
+
+        if handler is not None:
+            await handler(self, frame, direction)
+
+        await self.push_frame(frame, direction)
+
+async def run_bot(transport, args: RunnerArguments, user_name: str = None):
+    """Main bot logic"""
+    
+    # Create AI Services
+    stt = DeepgramSTTService(api_key=os.getenv("DEEPGRAM_API_KEY"))
+    tts = CartesiaTTSService(
+        api_key=os.getenv("CARTESIA_API_KEY"),
+        voice_id="bdab08ad-4137-4548-b9db-6142854c7525",  # Default Cartesia voice
+    )
+    llm = OpenAILLMService(api_key=os.getenv("OPENAI_API_KEY"), model="gpt-4o-mini")
+    
+    # Conversation context with custom persona (fresh list per session, shared system message)
+    messages = [*BASE_MESSAGES]
 
     context = OpenAILLMContext(messages)
     context_aggregator = llm.create_context_aggregator(context)
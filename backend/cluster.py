@@ -0,0 +1,84 @@
+"""
+Cross-worker routing of ICE candidates through Redis.
+
+Each worker owns the WebRTC connections it created. On /offer the owning worker
+records `conn:{pc_id} -> worker id` in Redis; a /candidate request that lands on
+another worker is published to the owner's channel and applied there.
+
+Disabled unless REDIS_URL is set, so single-worker deployments need no Redis.
+"""
+import asyncio
+import os
+import uuid
+import orjson
+from redis import asyncio as aioredis
+from loguru import logger
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Unique per process, so every uvicorn worker gets its own channel
+WORKER_ID = uuid.uuid4().hex
+
+# Candidates only trickle in while a session is being set up
+CONNECTION_OWNER_TTL = 3600  # seconds
+
+if REDIS_URL:
+    redis = aioredis.from_url(REDIS_URL)
+else:
+    redis = None
+
+def _owner_key(pc_id: str) -> str:
+    return f"conn:{pc_id}"
+
+def _candidates_channel(worker_id: str) -> str:
+    return f"candidates:{worker_id}"
+
+async def claim_connection(pc_id: str):
+    """Record this worker as the owner of a connection."""
+    if redis:
+        await redis.set(_owner_key(pc_id), WORKER_ID, ex=CONNECTION_OWNER_TTL)
+
+async def release_connection(pc_id: str):
+    """Forget the owner of a closed connection."""
+    if redis:
+        await redis.delete(_owner_key(pc_id))
+
+async def forward_candidates(pc_id: str, candidates: list) -> bool:
+    """
+    Publish candidates to the worker that owns the connection.
+
+    Returns:
+        bool: True if another worker owns the connection and received them
+    """
+    if not redis:
+        return False
+
+    owner = await redis.get(_owner_key(pc_id))
+    if not owner or owner.decode() == WORKER_ID:
+        return False
+
+    payload = orjson.dumps({"pc_id": pc_id, "candidates": candidates})
+    receivers = await redis.publish(_candidates_channel(owner.decode()), payload)
+    return receivers > 0
+
+async def listen_for_candidates(apply_candidates):
+    """Apply candidates forwarded by other workers for connections owned here."""
+    channel = _candidates_channel(WORKER_ID)
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(channel)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    # A bad message must not drop the subscription for every other connection
+                    try:
+                        data = orjson.loads(message["data"])
+                        await apply_candidates(data["pc_id"], data["candidates"])
+                    except Exception as e:
+                        logger.error(f"Failed to apply forwarded candidates: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Candidate listener failed, resubscribing: {e}")
+            await asyncio.sleep(1)
@@ -1,27 +1,36 @@
+import asyncio
 import os
+import secrets
 import sys
+import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from cachetools import TLRUCache
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from loguru import logger
+import orjson
 from aiortc.sdp import candidate_from_sdp
 from aiortc import RTCIceServer
 from pipecat.transports.smallwebrtc.request_handler import SmallWebRTCRequest
 from pipecat.transports.smallwebrtc.connection import SmallWebRTCConnection
 from bot import run_bot
-from pipecat.transports.smallwebrtc.transport import SmallWebRTCTransport, SmallWebRTCCallbacks
+from pipecat.transports.smallwebrtc.transport import SmallWebRTCTransport
 from pipecat.transports.base_transport import TransportParams
 import json
 import logging
 from pipecat.runner.types import RunnerArguments
 from pydantic import BaseModel
-from auth import supabase, get_current_user
+from auth import supabase, supabase_admin, get_current_user
+import cluster
 
 # --- Logging Configuration ---
 logger.remove()
-logger.add(sys.stderr, level="DEBUG")
-logging.basicConfig(level=logging.DEBUG) # Enable aiortc debug logs
+logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", "INFO"))
+# aiortc debug logs cover every packet, so only enable them on request
+if os.getenv("DEBUG_AIORTC", "").lower() in ("1", "true", "yes"):
+    logging.basicConfig(level=logging.DEBUG)
 
 # Suppress verbose HTTP client logs (httpx, httpcore, hpack)
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -44,20 +53,157 @@ def get_ice_servers():
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 7860))
 
+# Upper bound on tracked WebRTC connections; the oldest is closed beyond this
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 256))
+STALE_CONNECTION_REAP_INTERVAL = 60  # seconds
+STALE_CONNECTION_STATES = ("failed", "closed", "disconnected")
+
+# ICE servers are static config: parse once, reuse for every request
+ICE_SERVERS = get_ice_servers()
+RTC_ICE_SERVERS = [
+    RTCIceServer(
+        urls=server.get("urls"),
+        username=server.get("username"),
+        credential=server.get("credential")
+    ) for server in ICE_SERVERS
+]
+
+# The connection details served at `/` never change at runtime, so encode them once
+HOME_RESPONSE_BODY = orjson.dumps({
+    "transport": "webrtc",
+    "url": f"http://localhost:{PORT}",
+    "ice_servers": ICE_SERVERS
+})
+
 # --- State ---
-# Store active connections by pc_id
-active_connections = {}
+# Store active connections by pc_id, oldest first, with the id of the user who opened them
+active_connections: "OrderedDict[str, tuple[SmallWebRTCConnection, str]]" = OrderedDict()
+
+# Short-lived cache of /auth/check-email results: email -> exists.
+# Negative results expire sooner so a fresh signup isn't reported missing for long.
+_EMAIL_EXISTS_CACHE = TLRUCache(
+    maxsize=50_000,
+    ttu=lambda _email, exists, now: now + (60 if exists else 15),
+    timer=time.monotonic,
+)
+
+# In-flight email lookups, so concurrent checks for one email share a single RPC
+_email_checks_inflight: dict[str, asyncio.Task] = {}
+
+# Strong references to fire-and-forget close tasks (the loop only keeps weak ones)
+_background_tasks: set[asyncio.Task] = set()
+
+def redact_pc_id(pc_id) -> str:
+    """Shorten a pc_id for logs, since knowing the full id authorizes /candidate."""
+    return f"{pc_id[:6]}..." if isinstance(pc_id, str) else repr(pc_id)
+
+async def register_connection(pc_id: str, connection: SmallWebRTCConnection, user_id: str):
+    """Track a new connection, closing the oldest one once MAX_CONNECTIONS is reached."""
+    while len(active_connections) >= MAX_CONNECTIONS:
+        old_pc_id, (old_connection, _) = active_connections.popitem(last=False)
+        logger.warning(f"Connection limit reached, closing oldest connection: {redact_pc_id(old_pc_id)}")
+        task = asyncio.create_task(old_connection._close())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    
+    # Drop the entry as soon as the peer connection closes (client left, ICE failed, timeout)
+    @connection.event_handler("closed")
+    async def on_closed(connection):
+        active_connections.pop(pc_id, None)
+        await cluster.release_connection(pc_id)
+    
+    active_connections[pc_id] = (connection, user_id)
+    try:
+        await cluster.claim_connection(pc_id)
+    except Exception:
+        # Don't keep a connection no worker can be routed to
+        active_connections.pop(pc_id, None)
+        await connection._close()
+        raise
+
+async def reap_stale_connections():
+    """Periodically close and drop connections whose peer is gone."""
+    while True:
+        await asyncio.sleep(STALE_CONNECTION_REAP_INTERVAL)
+        for pc_id, (connection, _) in list(active_connections.items()):
+            try:
+                if connection.pc.connectionState in STALE_CONNECTION_STATES:
+                    logger.info(f"Reaping stale connection: {redact_pc_id(pc_id)}")
+                    active_connections.pop(pc_id, None)
+                    await connection._close()
+            except Exception as e:
+                logger.error(f"Failed to reap connection {redact_pc_id(pc_id)}: {e}")
+
+async def add_candidates(connection: SmallWebRTCConnection, candidates: list):
+    """Parse trickled ICE candidates and add them to a connection."""
+    # Parse everything first (pure CPU), then add the candidates concurrently
+    parsed = []
+    for c in candidates:
+        candidate_str = c.get("candidate")
+        sdp_mid = c.get("sdp_mid")
+        sdp_mline_index = c.get("sdp_mline_index")
+        
+        # Skip if candidate string is empty (end of candidates)
+        if not candidate_str:
+            continue
+            
+        # Skip if missing required fields for aiortc
+        if sdp_mid is None and sdp_mline_index is None:
+            logger.debug("Skipping candidate without sdpMid or sdpMLineIndex")
+            continue
+        
+        try:
+            # Convert to aiortc candidate
+            candidate = candidate_from_sdp(candidate_str)
+            candidate.sdpMid = sdp_mid
+            candidate.sdpMLineIndex = sdp_mline_index
+            parsed.append(candidate)
+        except Exception as e:
+            logger.warning(f"Failed to parse candidate: {e}")
+            # Continue processing other candidates
+    
+    # aiortc has no bulk add and takes no lock per candidate, so just keep candidates
+    # for the same transceiver together (those without an m-line index go last)
+    parsed.sort(key=lambda candidate: (candidate.sdpMLineIndex is None, candidate.sdpMLineIndex or 0))
+    
+    results = await asyncio.gather(
+        *(connection.add_ice_candidate(candidate) for candidate in parsed),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to add candidate: {result}")
+
+async def apply_forwarded_candidates(pc_id: str, candidates: list):
+    """Add candidates another worker received for a connection owned here."""
+    entry = active_connections.get(pc_id)
+    if not entry:
+        logger.warning(f"Forwarded candidates for unknown pc_id: {redact_pc_id(pc_id)}")
+        return
+    await add_candidates(entry[0], candidates)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifecycle."""
+    reaper = asyncio.create_task(reap_stale_connections())
+    listener = None
+    if cluster.redis:
+        listener = asyncio.create_task(cluster.listen_for_candidates(apply_forwarded_candidates))
     yield
+    reaper.cancel()
+    if listener:
+        listener.cancel()
     # Cleanup
-    for conn in active_connections.values():
+    for conn, _ in list(active_connections.values()):
         await conn._close()
     active_connections.clear()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# --- Compression ---
+# SDP answers and ICE server configs are highly compressible text.
+# Added before CORS so it sits inside the CORS wrapper.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # --- CORS ---
 # Get frontend URL from environment (for production deployment)
@@ -72,13 +218,76 @@ allowed_origins = [
 # Remove duplicates
 allowed_origins = list(set(allowed_origins))
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+class FastCORS:
+    """
+    Pure ASGI CORS middleware for the allowed frontend origins.
+    
+    Headers are read straight from the raw ASGI scope, preflight requests are
+    answered without reaching the app, and other responses only get the CORS
+    headers appended to their start message.
+    """
+    
+    ALLOW_METHODS = b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+    
+    def __init__(self, app, origins):
+        self.app = app
+        self.allow = {origin.encode("latin-1") for origin in origins}
+        self.preflight_headers = [
+            (b"access-control-allow-methods", self.ALLOW_METHODS),
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-max-age", b"600"),
+            (b"vary", b"Origin"),
+        ]
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        origin = request_method = request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+        
+        # Preflight: answer directly
+        if origin is not None and scope["method"] == "OPTIONS" and request_method is not None:
+            if origin not in self.allow:
+                await send({
+                    "type": "http.response.start",
+                    "status": 400,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", b"22")],
+                })
+                await send({"type": "http.response.body", "body": b"Disallowed CORS origin"})
+                return
+            
+            headers = [(b"access-control-allow-origin", origin), *self.preflight_headers]
+            if request_headers:
+                headers.append((b"access-control-allow-headers", request_headers))
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        
+        if origin not in self.allow:
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"access-control-allow-origin", origin),
+                    (b"access-control-allow-credentials", b"true"),
+                    (b"vary", b"Origin"),
+                ]
+            await send(message)
+        
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(FastCORS, origins=allowed_origins)
 
 # --- Routes ---
 
@@ -99,8 +308,8 @@ async def signup(request: SignupRequest):
         if not supabase:
             raise HTTPException(status_code=500, detail="Authentication service not configured")
         
-        # Sign up user with Supabase
-        response = supabase.auth.sign_up({
+        # Sign up user with Supabase (sync client, so keep it off the event loop)
+        response = await asyncio.to_thread(supabase.auth.sign_up, {
             "email": request.email,
             "password": request.password,
             "options": {
@@ -113,6 +322,11 @@ async def signup(request: SignupRequest):
         if not response.user:
             raise HTTPException(status_code=400, detail="Signup failed")
         
+        # The account exists now; also detach any lookup still in flight so its
+        # older "not found" result doesn't get cached over this one
+        _EMAIL_EXISTS_CACHE[request.email] = True
+        _email_checks_inflight.pop(request.email, None)
+        
         return {
             "user": {
                 "id": response.user.id,
@@ -135,8 +349,8 @@ async def login(request: LoginRequest):
         if not supabase:
             raise HTTPException(status_code=500, detail="Authentication service not configured")
         
-        # Sign in user with Supabase
-        response = supabase.auth.sign_in_with_password({
+        # Sign in user with Supabase (sync client, so keep it off the event loop)
+        response = await asyncio.to_thread(supabase.auth.sign_in_with_password, {
             "email": request.email,
             "password": request.password
         })
@@ -164,11 +378,50 @@ async def get_me(current_user: dict = Depends(get_current_user)):
     """Get current authenticated user."""
     return {"user": current_user}
 
+async def _lookup_email(email: str) -> bool:
+    """Run the email_exists RPC and cache its result."""
+    # Single indexed lookup on auth.users via the `email_exists`
+    # security definer function (see AUTH.md for the SQL)
+    try:
+        response = await asyncio.to_thread(supabase_admin.rpc("email_exists", {"e": email}).execute)
+        exists = bool(response.data)
+        # Only cache if signup hasn't detached this lookup in the meantime
+        if _email_checks_inflight.get(email) is asyncio.current_task():
+            _EMAIL_EXISTS_CACHE[email] = exists
+        return exists
+    except Exception as e:
+        logger.error(f"Error checking email: {e}")
+        return False
+
+async def email_exists(email: str) -> bool:
+    """
+    Check whether an email is registered, using the cache and coalescing
+    concurrent lookups for the same email into one Supabase RPC.
+    
+    The lookup runs in its own task and every caller awaits it through
+    shield, so cancelling any one request never cancels it for the others.
+    """
+    cached = _EMAIL_EXISTS_CACHE.get(email)
+    if cached is not None:
+        return cached
+    
+    task = _email_checks_inflight.get(email)
+    if task is None:
+        task = asyncio.create_task(_lookup_email(email))
+        _email_checks_inflight[email] = task
+        
+        def forget(task):
+            # Signup may already have detached (or replaced) this entry
+            if _email_checks_inflight.get(email) is task:
+                del _email_checks_inflight[email]
+        task.add_done_callback(forget)
+    return await asyncio.shield(task)
+
 @app.post("/auth/check-email")
 async def check_email(request: Request):
     """Check if an email exists in the database."""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         email = data.get("email")
         
         if not email:
@@ -177,16 +430,7 @@ async def check_email(request: Request):
         if not supabase:
             raise HTTPException(status_code=500, detail="Authentication service not configured")
         
-        # Use admin API with pagination to check if email exists
-        # This is more efficient than fetching all users without pagination
-        try:
-            response = supabase.auth.admin.list_users(page=1, per_page=1000)
-            users = response if isinstance(response, list) else []
-            email_exists = any(user.email == email for user in users)
-            return {"exists": email_exists}
-        except Exception as e:
-            logger.error(f"Error checking email: {e}")
-            return {"exists": False}
+        return {"exists": await email_exists(email)}
             
     except Exception as e:
         logger.error(f"Check email error: {e}")
@@ -195,11 +439,7 @@ async def check_email(request: Request):
 @app.get("/")
 async def get_connection_details():
     """Return connection details for the frontend."""
-    return {
-        "transport": "webrtc", 
-        "url": f"http://localhost:{PORT}",
-        "ice_servers": get_ice_servers()
-    }
+    return Response(content=HOME_RESPONSE_BODY, media_type="application/json")
 
 @app.api_route("/health", methods=["GET", "HEAD"])
 async def health_check():
@@ -220,22 +460,17 @@ async def health_check():
 
 @app.post("/offer")
 async def offer_endpoint(request: SmallWebRTCRequest, current_user: dict = Depends(get_current_user)):
-    """Handle WebRTC offer from client (protected)."""
+    """
+    Handle WebRTC offer from client (protected).
+    
+    The offer is only applied after authentication: applying it starts ICE
+    gathering, including TURN allocations with the server's credentials.
+    """
     try:
         logger.info(f"WebRTC offer from user: {current_user['email']}")
         # 1. Create a new connection
-        # Configure STUN/TURN servers
-        ice_servers_config = get_ice_servers()
-        rtc_ice_servers = [
-            RTCIceServer(
-                urls=server.get("urls"),
-                username=server.get("username"),
-                credential=server.get("credential")
-            ) for server in ice_servers_config
-        ]
-        
         connection = SmallWebRTCConnection(
-            ice_servers=rtc_ice_servers
+            ice_servers=RTC_ICE_SERVERS
         )
         
         # 2. Initialize with offer
@@ -247,26 +482,15 @@ async def offer_endpoint(request: SmallWebRTCRequest, current_user: dict = Depen
             
         logger.debug(f"Generated Answer SDP: {answer['sdp']}")
             
-        pc_id = answer["pc_id"]
-        active_connections[pc_id] = connection
-        logger.info(f"Created connection with pc_id: {pc_id}")
-        logger.info(f"Active connections: {list(active_connections.keys())}")
+        # Issue an unguessable pc_id (pipecat's own is a per-process counter).
+        # /candidate accepts any request for a known pc_id, bound here under auth.
+        pc_id = secrets.token_urlsafe(24)
+        answer["pc_id"] = pc_id
+        await register_connection(pc_id, connection, current_user["id"])
+        logger.info(f"Created connection with pc_id: {redact_pc_id(pc_id)}")
+        logger.info(f"Active connections: {len(active_connections)}")
         
         # 3. Start the bot
-        # Create callbacks (empty for now as we don't handle app messages yet)
-        async def on_app_message(message, sender):
-            pass
-        async def on_client_connected(conn):
-            pass
-        async def on_client_disconnected(conn):
-            pass
-            
-        callbacks = SmallWebRTCCallbacks(
-            on_app_message=on_app_message,
-            on_client_connected=on_client_connected,
-            on_client_disconnected=on_client_disconnected
-        )
-        
         # Create transport
         transport = SmallWebRTCTransport(
             webrtc_connection=connection,
@@ -279,7 +503,6 @@ async def offer_endpoint(request: SmallWebRTCRequest, current_user: dict = Depen
         
         # Run bot in background with user's name
         runner_args = RunnerArguments()
-        import asyncio
         asyncio.create_task(run_bot(transport, runner_args, user_name=user_first_name))
         
         # 4. Return answer
@@ -287,59 +510,59 @@ async def offer_endpoint(request: SmallWebRTCRequest, current_user: dict = Depen
 
     except Exception as e:
         logger.error(f"Offer failed: {e}")
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/candidate")
-async def candidate_endpoint(request: Request, current_user: dict = Depends(get_current_user)):
-    """Handle ICE candidate from client."""
+async def candidate_endpoint(request: Request):
+    """
+    Handle ICE candidate from client.
+    
+    No token check here: the pc_id was issued by /offer to an authenticated
+    user, so knowing it is what authorizes the request.
+    """
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Request body must be an object")
         pc_id = data.get("pc_id")
         candidates = data.get("candidates", [])
         
-        logger.info(f"Received candidate for pc_id: {pc_id}")
-        logger.info(f"Active connections: {list(active_connections.keys())}")
+        # The body is unauthenticated and may be forwarded to another worker, so check its shape
+        if not isinstance(pc_id, str):
+            raise HTTPException(status_code=400, detail="pc_id must be a string")
+        if not isinstance(candidates, list) or not all(isinstance(c, dict) for c in candidates):
+            raise HTTPException(status_code=400, detail="candidates must be a list of objects")
+        
+        logger.info(f"Received candidate for pc_id: {redact_pc_id(pc_id)}")
+        logger.info(f"Active connections: {len(active_connections)}")
         
-        connection = active_connections.get(pc_id)
+        entry = active_connections.get(pc_id)
         
-        if not connection:
-            logger.warning(f"Connection not found for pc_id: {pc_id}")
+        if entry:
+            await add_candidates(entry[0], candidates)
+        elif not await cluster.forward_candidates(pc_id, candidates):
+            # Not ours, and no other worker owns it either
+            logger.warning(f"Connection not found for pc_id: {redact_pc_id(pc_id)}")
             raise HTTPException(status_code=404, detail="Connection not found")
             
-        for c in candidates:
-            candidate_str = c.get("candidate")
-            sdp_mid = c.get("sdp_mid")
-            sdp_mline_index = c.get("sdp_mline_index")
-            
-            # Skip if candidate string is empty (end of candidates)
-            if not candidate_str:
-                continue
-                
-            # Skip if missing required fields for aiortc
-            if sdp_mid is None and sdp_mline_index is None:
-                logger.debug("Skipping candidate without sdpMid or sdpMLineIndex")
-                continue
-            
-            try:
-                # Convert to aiortc candidate
-                candidate = candidate_from_sdp(candidate_str)
-                candidate.sdpMid = sdp_mid
-                candidate.sdpMLineIndex = sdp_mline_index
-                await connection.add_ice_candidate(candidate)
-            except Exception as e:
-                logger.warning(f"Failed to add candidate: {e}")
-                # Continue processing other candidates
-            
-        return {"status": "ok"}
-        
         return {"status": "ok"}
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Candidate endpoint error: {e}")
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host=HOST, port=PORT)
+    # "auto" picks uvloop/httptools when installed (uvloop is not available on Windows)
+    # Connections live in the worker that created them; with WORKERS > 1,
+    # set REDIS_URL so /candidate requests are routed to the owning worker.
+    uvicorn.run(
+        "server:app",
+        host=HOST,
+        port=PORT,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WORKERS", 1)),
+    )